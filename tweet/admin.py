@@ -1,13 +1,31 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
 from . import models
 
-class TweetAdmin(admin.ModelAdmin):
+class OnlyChangeList(ChangeList):
+    def get_queryset(self, request):
+        return super().get_queryset(request).only(*self.model_admin.list_only)
+
+class OnlyAdmin(admin.ModelAdmin):
+    """
+    Loads only the list_only fields on the changelist page.
+    The change form still loads every field.
+    """
+    list_only = ()
+
+    def get_changelist(self, request, **kwargs):
+        return OnlyChangeList if self.list_only else super().get_changelist(request, **kwargs)
+
+class TweetAdmin(OnlyAdmin):
     list_display = ('id', 'tweet_id', 'text', 'user_name', 'created_at')
+    list_only = ('id', 'tweet_id', 'text', 'user', 'created_at', 'user__name')
     search_fields=['text']
     ordering = ['-id']
+    list_select_related = ('user',)
 
-class UserAdmin(admin.ModelAdmin):
+class UserAdmin(OnlyAdmin):
     list_display = ('id', 'user_id', 'name', 'screen_name', 'created_at')
+    list_only = ('id', 'user_id', 'name', 'screen_name', 'created_at')
     search_fields=['name', 'screen_name']
     ordering = ['-id']
 
@@ -0,0 +1,12 @@
+try:
+    import orjson as json
+except ImportError:
+    import json
+
+
+def parse_raw(raw):
+    """
+    Parses a json status object given as bytes or str.
+    Uses orjson when it is installed, and the standard json module otherwise.
+    """
+    return json.loads(raw)
@@ -0,0 +1,32 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tweet', '0001_initial'),
+    ]
+
+    operations = [
+        # Reuse the existing user_id column instead of dropping its data
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RemoveField(
+                    model_name='tweet',
+                    name='user_id',
+                ),
+                migrations.AddField(
+                    model_name='tweet',
+                    name='user',
+                    field=models.ForeignKey(db_column='user_id', db_constraint=False, db_index=False, default=0, on_delete=django.db.models.deletion.DO_NOTHING, related_name='tweets', to='tweet.User', to_field='user_id'),
+                    preserve_default=False,
+                ),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='tweet',
+            name='user',
+            field=models.ForeignKey(db_column='user_id', db_constraint=False, db_index=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='tweets', to='tweet.User', to_field='user_id'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+from django.db import migrations
+
+
+# The admin searches text with icontains, which PostgreSQL compiles to
+# UPPER("text"::text) LIKE UPPER(%s). The index expression matches it.
+CREATE_INDEX_SQL = (
+    'CREATE INDEX IF NOT EXISTS tweet_text_trgm ON {table} '
+    'USING gin ((UPPER("text"::text)) gin_trgm_ops)'
+)
+DROP_INDEX_SQL = 'DROP INDEX IF EXISTS tweet_text_trgm'
+
+
+def create_text_trgm_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'"
+        )
+        if cursor.fetchone() is None:
+            # The search still works without the index, only slower
+            return
+    Tweet = apps.get_model('tweet', 'Tweet')
+    table = schema_editor.quote_name(Tweet._meta.db_table)
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    schema_editor.execute(CREATE_INDEX_SQL.format(table=table))
+
+
+def drop_text_trgm_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(DROP_INDEX_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tweet', '0002_tweet_user_foreignkey'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_text_trgm_index, drop_text_trgm_index),
+    ]
@@ -0,0 +1,24 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tweet', '0003_tweet_text_trgm'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='tweet',
+            name='created_at',
+            field=models.DateTimeField(),
+        ),
+        migrations.AddIndex(
+            model_name='tweet',
+            index=models.Index(fields=['user', 'created_at'], name='tweet_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tweet',
+            index=models.Index(fields=['-created_at'], name='tweet_created_desc_idx'),
+        ),
+    ]
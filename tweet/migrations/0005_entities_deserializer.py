@@ -0,0 +1,23 @@
+import annoying.fields
+from django.db import migrations
+import tweet.ingest
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tweet', '0004_tweet_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='tweet',
+            name='entities',
+            field=annoying.fields.JSONField(blank=True, deserializer=tweet.ingest.parse_raw, null=True, serializer=annoying.fields.dumps),
+        ),
+        migrations.AlterField(
+            model_name='user',
+            name='entities',
+            field=annoying.fields.JSONField(blank=True, deserializer=tweet.ingest.parse_raw, null=True, serializer=annoying.fields.dumps),
+        ),
+    ]
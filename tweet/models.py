@@ -1,23 +1,61 @@
-from django.db import models
+from django.db import connections, models, router, transaction
+from django.db.models import Case, Value, When
+from django.db.utils import NotSupportedError
 from django.conf import settings
 from datetime import datetime, timedelta
-from email.utils import parsedate
+from email.utils import parsedate_to_datetime
 from django.utils import timezone
+import functools
+import io
 import os
 import socket
 from annoying.fields import JSONField
-from annoying.functions import get_object_or_None
+
+from .ingest import parse_raw
 
 USE_TZ = getattr(settings, "USE_TZ", True)
 
-current_timezone = timezone.get_current_timezone()
+# Twitter's created_at is always in UTC
+CREATED_AT_TZ = timezone.utc if USE_TZ else None
+
+MONTHS = {
+    "Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6,
+    "Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12,
+}
 
 
 def parse_datetime(string):
-    if settings.USE_TZ:
-        return datetime(*(parsedate(string)[:6]), tzinfo=current_timezone)
-    else:
-        return datetime(*(parsedate(string)[:6]))
+    """
+    Parses Twitter's fixed created_at format, e.g. "Wed Oct 10 20:19:24 +0000 2018".
+    Falls back to the generic RFC 2822 parser for any other offset.
+    """
+    if string[20:25] == "+0000":
+        return datetime(
+            int(string[26:30]),
+            MONTHS[string[4:7]],
+            int(string[8:10]),
+            int(string[11:13]),
+            int(string[14:16]),
+            int(string[17:19]),
+            0,
+            CREATED_AT_TZ,
+        )
+    dt = parsedate_to_datetime(string)
+    # Normalise to UTC like the fast path; "-0000" parses as a naive datetime
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    dt = dt.astimezone(timezone.utc)
+    return dt if USE_TZ else dt.replace(tzinfo=None)
+
+
+class UserQuerySet(models.QuerySet):
+    def lean(self):
+        """
+        Defers the large columns that bulk queries rarely need.
+        """
+        return self.defer(
+            "entities", "description", "profile_banner_url", "profile_image_url_https"
+        )
 
 
 class User(models.Model):
@@ -56,14 +94,33 @@ class User(models.Model):
     )
 
     # Entities
-    entities = JSONField(blank=True, null=True)
+    entities = JSONField(blank=True, null=True, deserializer=parse_raw)
 
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = UserQuerySet.as_manager()
+
     def __unicode__(self):
         return self.name
 
 
+class TweetQuerySet(models.QuerySet):
+    def lean(self):
+        """
+        Defers the large columns that bulk queries rarely need.
+        """
+        return self.defer("entities")
+
+    def with_user(self, lean=False):
+        """
+        Fetches the users of the tweets with a single query on user_id,
+        so that user_name doesn't hit the database for each tweet.
+        With lean=True the users' large columns are deferred.
+        """
+        users = User.objects.lean() if lean else User.objects.all()
+        return self.prefetch_related(models.Prefetch("user", queryset=users))
+
+
 class Tweet(models.Model):
     """
     Selected fields from a Twitter Status object.
@@ -85,10 +142,22 @@ class Tweet(models.Model):
     truncated = models.BooleanField(default=False)
 
     # Basic user info
-    user_id = models.BigIntegerField()
+    # No database constraint: a tweet may be stored without its user, and
+    # deleting a user keeps their tweets. null=True makes select_related use
+    # a LEFT OUTER JOIN so that such tweets are still listed.
+    user = models.ForeignKey(
+        User,
+        to_field="user_id",
+        db_column="user_id",
+        on_delete=models.DO_NOTHING,
+        related_name="tweets",
+        null=True,
+        db_constraint=False,
+        db_index=False,  # covered by tweet_user_created_idx
+    )
 
     # Timing parameters
-    created_at = models.DateTimeField(db_index=True)  # should be UTC
+    created_at = models.DateTimeField()  # should be UTC
 
     # none, low, or medium
     filter_level = models.CharField(max_length=6, null=True, blank=True, default=None)
@@ -103,18 +172,33 @@ class Tweet(models.Model):
     retweeted_status_id = models.BigIntegerField(null=True, blank=True, default=None)
 
     # Entities
-    entities = JSONField(blank=True, null=True)
+    entities = JSONField(blank=True, null=True, deserializer=parse_raw)
 
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = TweetQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "created_at"], name="tweet_user_created_idx"),
+            models.Index(fields=["-created_at"], name="tweet_created_desc_idx"),
+        ]
+
     @property
     def is_retweet(self):
         return self.retweeted_status_id is not None
 
     @property
     def user_name(self):
-        user = get_object_or_None(User, user_id=self.user_id)
-        return user.name if user else None
+        if Tweet.user.is_cached(self):
+            user = self.user
+            return user.name if user is not None else None
+        # Fetch only the name instead of loading the whole User
+        return (
+            User.objects.filter(user_id=self.user_id)
+            .values_list("name", flat=True)
+            .first()
+        )
 
     @classmethod
     def get_created_in_range(cls, start, end):
@@ -123,39 +207,57 @@ class Tweet(models.Model):
         """
         return cls.objects.filter(created_at__gte=start, created_at__lt=end)
 
+    @classmethod
+    def iter_created_in_range(cls, start, end):
+        """
+        Iterates over the tweets between start and end in created_at order
+        without caching them, for ranges too large to load at once.
+        """
+        return cls.get_created_in_range(start, end).order_by("created_at").iterator()
+
     @classmethod
     def get_earliest_created_at(cls):
         """
         Returns the earliest created_at time, or None
         """
-        result = cls.objects.aggregate(earliest_created_at=models.Min("created_at"))
-        return result["earliest_created_at"]
+        return (
+            cls.objects.order_by("created_at")
+            .values_list("created_at", flat=True)
+            .first()
+        )
 
     @classmethod
     def get_latest_created_at(cls):
         """
         Returns the latest created_at time, or None
         """
-        result = cls.objects.aggregate(latest_created_at=models.Max("created_at"))
-        return result["latest_created_at"]
+        return (
+            cls.objects.order_by("-created_at")
+            .values_list("created_at", flat=True)
+            .first()
+        )
 
     def __unicode__(self):
         return self.text
 
 
-def create_or_update_from_json(raw, save_rts):
+def _build_defaults(raw, save_rts):
     """
-    Given a *parsed* json status object, construct a new Tweet and User model.
+    Given a json status object, return the field values of the Tweet and User
+    models, or None if the status should be skipped.
     """
 
-    raw_user = raw["user"]
+    if isinstance(raw, (bytes, str)):
+        raw = parse_raw(raw)
+
     retweeted_status = raw.get("retweeted_status")
-    if retweeted_status is None:
-        retweeted_status = {"id": None}
+    retweeted_status_id = retweeted_status["id"] if retweeted_status else None
 
     # Skip processing retweet
-    if save_rts is False and retweeted_status["id"]:
-        return
+    if save_rts is False and retweeted_status_id:
+        return None
+
+    raw_user = raw["user"]
 
     # Replace negative counts with None to indicate missing data
     counts = {
@@ -196,7 +298,7 @@ def create_or_update_from_json(raw, save_rts):
         retweet_count=counts.get("retweet_count"),
         # Relation to other tweets
         in_reply_to_status_id=raw.get("in_reply_to_status_id"),
-        retweeted_status_id=retweeted_status["id"],
+        retweeted_status_id=retweeted_status_id,
         # Entities
         entities=raw.get("entities"),
     )
@@ -228,22 +330,301 @@ def create_or_update_from_json(raw, save_rts):
         entities=raw_user.get("entities"),
     )
 
-    # get_or_update Tweet object
-    tweet, tweet_created = Tweet.objects.get_or_create(
-        tweet_id=raw["id"], defaults=tweet_defaults
-    )
-    if not tweet_created:
-        for k, v in tweet_defaults.items():
-            setattr(tweet, k, v)
-        tweet.save()
-
-    # get_or_update User object
-    user, user_created = User.objects.get_or_create(
-        user_id=raw_user["id"], defaults=user_defaults
+    return tweet_defaults, user_defaults
+
+
+def _changed_fields(obj, values):
+    """
+    Returns the names in values whose value differs from the one on obj.
+    """
+    return [k for k, v in values.items() if getattr(obj, k) != v]
+
+
+def _create_or_update(model, unique_field, defaults):
+    """
+    Creates the object, or saves only its changed fields if it already exists.
+    Nothing is written when the stored object is identical.
+    """
+    obj, created = model.objects.get_or_create(
+        defaults=defaults, **{unique_field: defaults[unique_field]}
     )
-    if not user_created:
-        for k, v in user_defaults.items():
-            setattr(user, k, v)
-        user.save()
+    if not created:
+        changed = _changed_fields(obj, defaults)
+        if changed:
+            for k in changed:
+                setattr(obj, k, defaults[k])
+            obj.save(update_fields=changed + ["updated_at"])
+    return obj
+
+
+def create_or_update_from_json(raw, save_rts):
+    """
+    Given a json status object, construct a new Tweet and User model.
+    The status may be already parsed, or given as bytes or str.
+    """
+
+    defaults = _build_defaults(raw, save_rts)
+    if defaults is None:
+        return
+    tweet_defaults, user_defaults = defaults
+
+    # Save the User first as Tweet references it
+    user = _create_or_update(User, "user_id", user_defaults)
+    tweet = _create_or_update(Tweet, "tweet_id", tweet_defaults)
 
     return tweet, user
+
+
+def _cap_batch_size(connection, fields, objs, batch_size):
+    """
+    Caps batch_size to what the database accepts in a single query.
+    """
+    max_batch_size = connection.ops.bulk_batch_size(fields, objs)
+    return min(batch_size, max_batch_size) if max_batch_size else batch_size
+
+
+def _bulk_update(model, objs, fields, batch_size):
+    """
+    Updates the given fields of the objects with one UPDATE per batch,
+    setting each column with a CASE on the primary key.
+    """
+    connection = connections[router.db_for_write(model)]
+    # Each object takes a WHEN pk and a THEN value per field, plus its pk IN entry
+    params = ["pk"] * (2 * len(fields) + 1)
+    batch_size = _cap_batch_size(connection, params, objs, batch_size)
+    for i in range(0, len(objs), batch_size):
+        batch = objs[i : i + batch_size]
+        values = {}
+        for name in fields:
+            field = model._meta.get_field(name)
+            whens = [
+                When(pk=obj.pk, then=Value(getattr(obj, name), output_field=field))
+                for obj in batch
+            ]
+            values[name] = Case(*whens, output_field=field)
+        model.objects.filter(pk__in=[obj.pk for obj in batch]).update(**values)
+
+
+def _bulk_create_or_update(model, unique_field, objs, batch_size):
+    """
+    Insert the objects whose unique_field is not stored yet in batches,
+    and update the changed fields of the stored ones in batches.
+    """
+    keys = [getattr(obj, unique_field) for obj in objs]
+    existing = {}
+    connection = connections[router.db_for_read(model)]
+    lookup_batch_size = _cap_batch_size(
+        connection, [model._meta.get_field(unique_field)], keys, batch_size
+    )
+    for i in range(0, len(keys), lookup_batch_size):
+        lookup = {unique_field + "__in": keys[i : i + lookup_batch_size]}
+        for stored in model.objects.filter(**lookup):
+            existing[getattr(stored, unique_field)] = stored
+
+    new_objs = [obj for obj in objs if getattr(obj, unique_field) not in existing]
+    if new_objs:
+        connection = connections[router.db_for_write(model)]
+        fields = [f for f in model._meta.concrete_fields if not f.primary_key]
+        insert_batch_size = _cap_batch_size(connection, fields, new_objs, batch_size)
+        model.objects.bulk_create(new_objs, batch_size=insert_batch_size)
+
+    attnames = [
+        f.attname
+        for f in model._meta.concrete_fields
+        if not f.primary_key and f.name != "updated_at"
+    ]
+    changed_objs = []
+    changed_fields = set()
+    for obj in objs:
+        stored = existing.get(getattr(obj, unique_field))
+        if stored is None:
+            continue
+        values = {k: getattr(obj, k) for k in attnames}
+        changed = _changed_fields(stored, values)
+        if changed:
+            for k in changed:
+                setattr(stored, k, values[k])
+            changed_objs.append(stored)
+            changed_fields.update(changed)
+
+    if changed_objs:
+        now = timezone.now()
+        for stored in changed_objs:
+            stored.updated_at = now
+        fields = sorted(changed_fields) + ["updated_at"]
+        _bulk_update(model, changed_objs, fields, batch_size)
+
+
+def _upsert_fields(model):
+    return [f for f in model._meta.concrete_fields if not f.primary_key]
+
+
+def _db_values(connection, fields, obj):
+    """
+    Returns the values of the fields of an unsaved object, ready for raw SQL.
+    """
+    return [f.get_db_prep_save(f.pre_save(obj, True), connection) for f in fields]
+
+
+@functools.lru_cache(maxsize=None)
+def _upsert_sql(alias, model, unique_field, tmp_table=None):
+    """
+    Builds the PostgreSQL INSERT ... ON CONFLICT DO UPDATE statement of the model
+    once per database alias. The rows are selected from tmp_table if given, and
+    are otherwise passed as a VALUES %s list. Stored rows are only rewritten
+    when they changed.
+    """
+    qn = connections[alias].ops.quote_name
+    fields = _upsert_fields(model)
+    table = qn(model._meta.db_table)
+    columns = ", ".join(qn(f.column) for f in fields)
+    # updated_at always differs, so leave it out of the change detection
+    compared = [qn(f.column) for f in fields if f.name != "updated_at"]
+
+    if tmp_table is None:
+        source = "VALUES %s"
+    else:
+        source = "SELECT {} FROM {}".format(columns, qn(tmp_table))
+
+    return (
+        "INSERT INTO {table} ({columns}) {source} "
+        "ON CONFLICT ({unique}) DO UPDATE SET {updates} "
+        "WHERE ({stored}) IS DISTINCT FROM ({excluded})".format(
+            table=table,
+            columns=columns,
+            source=source,
+            unique=qn(model._meta.get_field(unique_field).column),
+            updates=", ".join(
+                "{0} = EXCLUDED.{0}".format(qn(f.column)) for f in fields
+            ),
+            stored=", ".join("{}.{}".format(table, c) for c in compared),
+            excluded=", ".join("EXCLUDED.{}".format(c) for c in compared),
+        )
+    )
+
+
+def _execute_upsert(connection, model, unique_field, objs, batch_size):
+    """
+    Inserts or updates the objects with multi-row INSERT ... ON CONFLICT
+    statements, bypassing the ORM.
+    """
+    from psycopg2.extras import execute_values
+
+    fields = _upsert_fields(model)
+    rows = [_db_values(connection, fields, obj) for obj in objs]
+    with connection.cursor() as cursor:
+        execute_values(
+            cursor.cursor,
+            _upsert_sql(connection.alias, model, unique_field),
+            rows,
+            page_size=batch_size,
+        )
+
+
+def _build_objects(raws, save_rts):
+    """
+    Given a list of json status objects, return the unsaved Tweet and User
+    models to store, without duplicates.
+    """
+
+    # Dedupe tweets and users to write each of them once per batch.
+    # Later occurrences overwrite earlier ones, so the latest data wins.
+    tweets_by_id = {}
+    users_by_id = {}
+    for raw in raws:
+        defaults = _build_defaults(raw, save_rts)
+        if defaults is None:
+            continue
+        tweet_defaults, user_defaults = defaults
+        tweets_by_id[tweet_defaults["tweet_id"]] = Tweet(**tweet_defaults)
+        users_by_id[user_defaults["user_id"]] = User(**user_defaults)
+    return list(tweets_by_id.values()), list(users_by_id.values())
+
+
+def create_or_update_many_from_json(raws, save_rts, batch_size=10000):
+    """
+    Given a list of json status objects, create or update the Tweet and User
+    models in bulk. The statuses may be already parsed, or given as bytes or str.
+    Returns nothing: unlike create_or_update_from_json, no saved models are
+    built, so query the stored rows if you need them.
+    """
+
+    tweet_objs, user_objs = _build_objects(raws, save_rts)
+
+    connection = connections[router.db_for_write(Tweet)]
+    with transaction.atomic(using=connection.alias):
+        if connection.vendor == "postgresql":
+            _execute_upsert(connection, User, "user_id", user_objs, batch_size)
+            _execute_upsert(connection, Tweet, "tweet_id", tweet_objs, batch_size)
+        else:
+            _bulk_create_or_update(User, "user_id", user_objs, batch_size)
+            _bulk_create_or_update(Tweet, "tweet_id", tweet_objs, batch_size)
+
+
+def _copy_value(value):
+    """
+    Formats a database value for COPY's text format.
+    """
+    if value is None:
+        return "\\N"
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def _copy_upsert(connection, model, unique_field, objs):
+    """
+    Loads the objects into a temporary table with COPY, then inserts them
+    into the model's table in one statement.
+    """
+    qn = connection.ops.quote_name
+    fields = _upsert_fields(model)
+    tmp_table = model._meta.db_table + "_copy"
+    columns = ", ".join(qn(f.column) for f in fields)
+
+    buf = io.StringIO()
+    for obj in objs:
+        values = _db_values(connection, fields, obj)
+        buf.write("\t".join(_copy_value(v) for v in values))
+        buf.write("\n")
+    buf.seek(0)
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "CREATE TEMPORARY TABLE {tmp} ON COMMIT DROP AS "
+            "SELECT {columns} FROM {table} WITH NO DATA".format(
+                tmp=qn(tmp_table), columns=columns, table=qn(model._meta.db_table)
+            )
+        )
+        cursor.copy_expert(
+            "COPY {tmp} ({columns}) FROM STDIN".format(
+                tmp=qn(tmp_table), columns=columns
+            ),
+            buf,
+        )
+        cursor.execute(_upsert_sql(connection.alias, model, unique_field, tmp_table))
+        cursor.execute("DROP TABLE {tmp}".format(tmp=qn(tmp_table)))
+
+
+def copy_many_from_json(raws, save_rts):
+    """
+    Given a list of json status objects, create or update the Tweet and User
+    models with PostgreSQL's COPY. Faster than create_or_update_many_from_json
+    for backfilling large archives. Returns nothing.
+    """
+
+    connection = connections[router.db_for_write(Tweet)]
+    if connection.vendor != "postgresql":
+        raise NotSupportedError("copy_many_from_json requires PostgreSQL.")
+
+    tweet_objs, user_objs = _build_objects(raws, save_rts)
+
+    with transaction.atomic(using=connection.alias):
+        _copy_upsert(connection, User, "user_id", user_objs)
+        _copy_upsert(connection, Tweet, "tweet_id", tweet_objs)
@@ -0,0 +1,12 @@
+from celery import shared_task
+
+from .models import create_or_update_many_from_json
+
+
+@shared_task
+def ingest_batch(raws, save_rts):
+    """
+    Creates or updates the Tweet and User models from a list of json status
+    objects, outside of the request/response cycle.
+    """
+    create_or_update_many_from_json(raws, save_rts)
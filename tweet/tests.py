@@ -0,0 +1,234 @@
+from datetime import datetime
+from unittest import mock, skipUnless
+
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from . import models
+from .models import (
+    Tweet,
+    User,
+    copy_many_from_json,
+    create_or_update_many_from_json,
+    parse_datetime,
+)
+
+
+def make_status(tweet_id, user_id, **kwargs):
+    """
+    Returns a parsed json status object, with kwargs overriding its fields.
+    """
+    status = {
+        "id": tweet_id,
+        "text": "Hello",
+        "truncated": False,
+        "created_at": "Wed Oct 10 20:19:24 +0000 2018",
+        "filter_level": "low",
+        "reply_count": 1,
+        "retweet_count": 2,
+        "favorite_count": 3,
+        "in_reply_to_status_id": None,
+        "entities": {"hashtags": []},
+        "user": {
+            "id": user_id,
+            "name": "User %d" % user_id,
+            "screen_name": "user%d" % user_id,
+            "location": "Tokyo",
+            "url": "https://example.com/",
+            "description": "Description",
+            "protected": False,
+            "verified": False,
+            "followers_count": 10,
+            "friends_count": 20,
+            "listed_count": 30,
+            "favourites_count": 40,
+            "statuses_count": 50,
+            "created_at": "Mon Jan 01 00:00:00 +0000 2018",
+            "entities": {"url": {}},
+        },
+    }
+    status.update(kwargs)
+    return status
+
+
+class ParseDatetimeTests(SimpleTestCase):
+    utc = datetime(2018, 10, 10, 20, 19, 24, tzinfo=timezone.utc)
+
+    def test_fast_path(self):
+        self.assertEqual(parse_datetime("Wed Oct 10 20:19:24 +0000 2018"), self.utc)
+        self.assertEqual(
+            parse_datetime("Sun Dec 31 23:59:59 +0000 2006"),
+            datetime(2006, 12, 31, 23, 59, 59, tzinfo=timezone.utc),
+        )
+
+    def test_fallback_is_normalised_to_utc(self):
+        dt = parse_datetime("Thu Oct 11 05:19:24 +0900 2018")
+        self.assertEqual(dt, self.utc)
+        self.assertEqual(dt.utcoffset().total_seconds(), 0)
+
+    def test_fallback_unknown_offset_is_utc(self):
+        self.assertEqual(parse_datetime("Wed Oct 10 20:19:24 -0000 2018"), self.utc)
+
+    def test_naive_without_use_tz(self):
+        naive = datetime(2018, 10, 10, 20, 19, 24)
+        with mock.patch.object(models, "USE_TZ", False), mock.patch.object(
+            models, "CREATED_AT_TZ", None
+        ):
+            for string in [
+                "Wed Oct 10 20:19:24 +0000 2018",
+                "Thu Oct 11 05:19:24 +0900 2018",
+                "Wed Oct 10 20:19:24 -0000 2018",
+            ]:
+                self.assertEqual(parse_datetime(string), naive)
+
+
+class BatchIngestTests(TestCase):
+    """
+    Tests the batch ingestion. PostgreSQL runs the raw INSERT ... ON CONFLICT
+    path, other backends the bulk_create and CASE UPDATE path.
+    """
+
+    def ingest(self, raws):
+        create_or_update_many_from_json(raws, True)
+
+    def assertQueryParamsWithinLimit(self, func, *args):
+        """
+        Calls func and checks that no query bound more parameters than the
+        backend accepts. Only checked where Django exposes the limit.
+        """
+        limit = getattr(connection.features, "max_query_params", None)
+        if limit is None or not hasattr(connection, "execute_wrapper"):
+            return func(*args)
+
+        sizes = [0]
+
+        def record(execute, sql, params, many, context):
+            if not many:
+                sizes.append(len(params or ()))
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(record):
+            func(*args)
+        self.assertLessEqual(max(sizes), limit)
+
+    def test_insert(self):
+        self.ingest([make_status(1, 10), make_status(2, 10), make_status(3, 20)])
+
+        self.assertEqual(Tweet.objects.count(), 3)
+        self.assertEqual(User.objects.count(), 2)
+        tweet = Tweet.objects.get(tweet_id=1)
+        self.assertEqual(tweet.text, "Hello")
+        self.assertEqual(tweet.user_id, 10)
+        self.assertEqual(tweet.retweet_count, 2)
+        self.assertEqual(tweet.entities, {"hashtags": []})
+        self.assertEqual(tweet.user_name, "User 10")
+
+    def test_unchanged_rows_are_not_rewritten(self):
+        raws = [make_status(1, 10), make_status(2, 10)]
+        self.ingest(raws)
+        tweets = {t.tweet_id: t.updated_at for t in Tweet.objects.all()}
+        user_updated_at = User.objects.get(user_id=10).updated_at
+
+        self.ingest(raws)
+
+        for tweet in Tweet.objects.all():
+            self.assertEqual(tweet.updated_at, tweets[tweet.tweet_id])
+        self.assertEqual(User.objects.get(user_id=10).updated_at, user_updated_at)
+
+    def test_changed_row_is_updated(self):
+        self.ingest([make_status(1, 10), make_status(2, 10)])
+        unchanged = Tweet.objects.get(tweet_id=2)
+        changed = Tweet.objects.get(tweet_id=1)
+
+        self.ingest([make_status(1, 10, retweet_count=5), make_status(2, 10)])
+
+        tweet = Tweet.objects.get(tweet_id=1)
+        self.assertEqual(tweet.retweet_count, 5)
+        self.assertEqual(tweet.pk, changed.pk)
+        self.assertGreater(tweet.updated_at, changed.updated_at)
+        self.assertEqual(Tweet.objects.get(tweet_id=2).updated_at, unchanged.updated_at)
+        self.assertEqual(Tweet.objects.count(), 2)
+
+    def test_batch_over_parameter_limit(self):
+        # More rows than fit in SQLite's 999 parameters per query
+        raws = [make_status(i, i) for i in range(1, 1201)]
+        self.assertQueryParamsWithinLimit(self.ingest, raws)
+        self.assertEqual(Tweet.objects.count(), 1200)
+        self.assertEqual(User.objects.count(), 1200)
+
+        for raw in raws:
+            raw["retweet_count"] = 7
+            raw["favorite_count"] = 8
+        self.assertQueryParamsWithinLimit(self.ingest, raws)
+        self.assertEqual(
+            Tweet.objects.filter(retweet_count=7, favorite_count=8).count(), 1200
+        )
+
+    def test_special_characters(self):
+        text = "tab\there\nnew line\r\\ backslash \\N"
+        status = make_status(1, 10, text=text)
+        status["user"]["description"] = "C:\\path\tto\nfile"
+        self.ingest([status])
+
+        self.assertEqual(Tweet.objects.get(tweet_id=1).text, text)
+        self.assertEqual(
+            User.objects.get(user_id=10).description, "C:\\path\tto\nfile"
+        )
+
+    def test_null_columns(self):
+        status = make_status(
+            1, 10, filter_level=None, reply_count=-1, entities=None, text=""
+        )
+        status["user"]["url"] = None
+        status["user"]["location"] = ""
+        self.ingest([status])
+
+        tweet = Tweet.objects.get(tweet_id=1)
+        self.assertIsNone(tweet.filter_level)
+        self.assertIsNone(tweet.reply_count)
+        self.assertIsNone(tweet.in_reply_to_status_id)
+        self.assertIsNone(tweet.retweeted_status_id)
+        self.assertIsNone(tweet.entities)
+        self.assertEqual(tweet.text, "")
+        user = User.objects.get(user_id=10)
+        self.assertIsNone(user.url)
+        self.assertEqual(user.location, "")
+
+
+@skipUnless(connection.vendor == "postgresql", "PostgreSQL only")
+class CopyTests(BatchIngestTests):
+    """
+    Runs the same tests through the COPY backfill path.
+    """
+
+    def ingest(self, raws):
+        copy_many_from_json(raws, True)
+
+    def test_repeated_copy_in_one_transaction(self):
+        # The temporary tables must not outlive a single call
+        self.ingest([make_status(1, 10)])
+        self.ingest([make_status(2, 10)])
+
+        self.assertEqual(Tweet.objects.count(), 2)
+
+
+class WithUserTests(TestCase):
+    def setUp(self):
+        create_or_update_many_from_json([make_status(1, 10), make_status(2, 20)], True)
+
+    def test_user_name_without_extra_queries(self):
+        tweets = list(Tweet.objects.with_user())
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                sorted(t.user_name for t in tweets), ["User 10", "User 20"]
+            )
+            self.assertEqual(tweets[0].user.description, "Description")
+
+    def test_lean_defers_user_columns(self):
+        tweet = Tweet.objects.with_user(lean=True).get(tweet_id=1)
+        self.assertIn("description", tweet.user.get_deferred_fields())
+        self.assertNotIn(
+            "description",
+            Tweet.objects.with_user().get(tweet_id=1).user.get_deferred_fields(),
+        )